@@ -1,9 +1,11 @@
-from functools import partial
+import atexit
+from functools import lru_cache, partial
+from operator import attrgetter
 
 import numpy as np
 import tables
 from astropy.time import Time
-from astropy.units import Quantity
+from astropy.units import Quantity, Unit, UnitBase
 
 import ctapipe
 from .tableio import TableWriter, TableReader
@@ -14,13 +16,11 @@ __all__ = [
     'HDF5TableReader'
 ]
 
+# column types for plain python values, numpy arrays and scalars are mapped
+# directly from their dtype
 PYTABLES_TYPE_MAP = {
     'float': tables.Float64Col,
-    'float64': tables.Float64Col,
-    'float32': tables.Float32Col,
     'int': tables.IntCol,
-    'int32': tables.Int32Col,
-    'int64': tables.Int64Col,
     'bool': tables.BoolCol,
 }
 
@@ -53,6 +53,11 @@ class HDF5TableWriter(TableWriter):
     To append to existing files, pass the `mode='a'`  option to the
     constructor.
 
+    Rows are buffered in memory and written to the file in bulk. Call
+    `close()` (or use the writer as a context manager) or `flush()` to write
+    them; rows still buffered when the interpreter exits are written then,
+    as long as the file is still open.
+
     Parameters
     ----------
     filename: str
@@ -65,18 +70,42 @@ class HDF5TableWriter(TableWriter):
         'a' if you want to append data to the file
     root_uep : str
         root location of the `group_name`
+    flush_every: int
+        number of rows buffered in memory for each table before they are
+        written to the file in a single `tables.Table.append()` call
+        (buffered rows are always written by `flush()` and `close()`)
+    max_buffer_bytes: int
+        upper limit on the size of the row buffer of each table: tables with
+        wide rows (e.g. waveforms) buffer fewer than `flush_every` rows
+    expectedrows: int
+        estimated number of rows of each table, used by pytables to choose
+        the chunk size of new tables (can be set per table in `write()`)
+    complib: str
+        compression library used when no `filters` are given
+        (default: 'blosc:lz4', which is usually faster than writing the
+        uncompressed data)
+    complevel: int
+        compression level used when no `filters` are given (default: 5)
     kwargs:
         any other arguments that will be passed through to `pytables.open()`.
         e.g. to set the compression level to 7 pass : `filters=tables.Filters(
-        complevel=7)`
+        complevel=7)`, or `filters=tables.Filters()` to disable compression
 
     """
 
-    def __init__(self, filename, group_name, mode='w', root_uep='/', **kwargs):
+    def __init__(self, filename, group_name, mode='w', root_uep='/',
+                 flush_every=1000, max_buffer_bytes=16 * 1024**2,
+                 expectedrows=1000000, **kwargs):
 
         super().__init__()
         self._schemas = {}
         self._tables = {}
+        self._buffers = {}
+        self._plan = {}
+        self._field_getters = {}
+        self.flush_every = flush_every
+        self.max_buffer_bytes = max_buffer_bytes
+        self.expectedrows = expectedrows
 
         if mode not in ['a', 'w', 'r+']:
 
@@ -87,6 +116,13 @@ class HDF5TableWriter(TableWriter):
 
         self.open(filename, **kwargs)
 
+        # write rows that are still buffered if the writer is never closed,
+        # before pytables closes the open files at exit. This must not
+        # refer to self, so that the writer can be garbage collected.
+        self._flush_at_exit = partial(_flush_buffers, self._h5file,
+                                      self._buffers)
+        atexit.register(self._flush_at_exit)
+
         if root_uep + group_name in self._h5file:
 
             self._group = self._h5file.get_node(root_uep + group_name)
@@ -99,12 +135,61 @@ class HDF5TableWriter(TableWriter):
 
     def open(self, filename, **kwargs):
 
+        complib = kwargs.pop('complib', 'blosc:lz4')
+        complevel = kwargs.pop('complevel', 5)
+        if 'filters' not in kwargs:
+            kwargs['filters'] = tables.Filters(complib=complib,
+                                               complevel=complevel,
+                                               shuffle=True)
+
         self.log.debug("kwargs for tables.open_file: %s", kwargs)
         self._h5file = tables.open_file(filename, **kwargs)
 
     def close(self):
 
-        self._h5file.close()
+        # safe to call more than once, or if the constructor failed
+        h5file = getattr(self, '_h5file', None)
+        if h5file is not None and h5file.isopen:
+            atexit.unregister(self._flush_at_exit)
+            try:
+                self.flush()
+            finally:
+                h5file.close()
+
+    def flush(self):
+        """ write all buffered rows of all tables to the file """
+        _flush_buffers(self._h5file, self._buffers)
+
+    def add_column_transform(self, table_name, col_name, transform):
+        """
+        Add a transformation function for a column, see
+        `TableWriter.add_column_transform`. If the table was already
+        written to, the transform applies to the rows written from now on.
+        """
+        super().add_column_transform(table_name, col_name, transform)
+
+        if table_name not in self._plan:
+            return  # the plan is built with the transform when set up
+
+        table = self._tables[table_name]
+        if col_name in table.colnames:
+            # rows already buffered keep the previous transform
+            buffer = self._buffers[table_name]
+            buffer.flush()
+            buffer.deferred_times.pop(col_name, None)
+            buffer.pending_times.pop(col_name, None)
+
+            plan = self._plan[table_name]
+            index = table.colnames.index(col_name)
+            _, ci, fi = plan[index]
+            plan[index] = (transform, ci, fi)
+
+    def _check_open(self):
+        """ rows written after `close()` would only be buffered and lost """
+        if not self._h5file.isopen:
+            raise tables.ClosedFileError(
+                "the file {} is closed".format(self._h5file.filename)
+            )
 
     def _create_hdf5_table_schema(self, table_name, containers):
         """
@@ -143,7 +228,17 @@ class HDF5TableWriter(TableWriter):
                 if isinstance(value, Quantity):
                     req_unit = container.fields[col_name].unit
                     if req_unit is not None:
-                        tr = partial(tr_convert_and_strip_unit, unit=req_unit)
+                        if (isinstance(value.unit, UnitBase)
+                                and value.unit.is_equivalent(req_unit)):
+                            # plain units only differ by a scale factor, so
+                            # compute it once instead of calling to() per row
+                            tr = partial(tr_scale_and_strip_unit,
+                                         unit=req_unit,
+                                         from_unit=value.unit,
+                                         factor=value.unit.to(req_unit))
+                        else:
+                            tr = partial(tr_convert_and_strip_unit,
+                                         unit=req_unit)
                         meta['{}_UNIT'.format(col_name)] = str(req_unit)
                     else:
                         tr = lambda x: x.value
@@ -152,13 +247,14 @@ class HDF5TableWriter(TableWriter):
                     value = tr(value)
                     self.add_column_transform(table_name, col_name, tr)
 
-                if isinstance(value, np.ndarray):
+                if isinstance(value, (np.ndarray, np.generic)):
                     typename = value.dtype.name
-                    coltype = PYTABLES_TYPE_MAP[typename]
                     shape = value.shape
-                    Schema.columns[col_name] = coltype(shape=shape)
+                    Schema.columns[col_name] = tables.Col.from_dtype(
+                        np.dtype((value.dtype, shape))
+                    )
 
-                if isinstance(value, Time):
+                elif isinstance(value, Time):
                     # TODO: really should use MET, but need a func for that
                     Schema.columns[col_name] = tables.Float64Col()
                     self.add_column_transform(
@@ -177,9 +273,12 @@ class HDF5TableWriter(TableWriter):
         meta['CTAPIPE_VERSION'] = ctapipe.__version__
         return meta
 
-    def _setup_new_table(self, table_name, containers):
+    def _setup_new_table(self, table_name, containers, expectedrows=None):
         """ set up the table. This is called the first time `write()`
         is called on a new table """
+        if expectedrows is None:
+            expectedrows = self.expectedrows
+
         self.log.debug("Initializing table '%s'", table_name)
         meta = self._create_hdf5_table_schema(table_name, containers)
 
@@ -192,32 +291,173 @@ class HDF5TableWriter(TableWriter):
             title="Storage of {}".format(
                 ",".join(c.__class__.__name__ for c in containers)
             ),
-            description=self._schemas[table_name]
+            description=self._schemas[table_name],
+            expectedrows=expectedrows,
         )
         for key, val in meta.items():
             table.attrs[key] = val
 
         self._tables[table_name] = table
 
+        # snapshot of the fields of each container, which are fetched all at
+        # once for each row
+        container_fields = [tuple(c.keys()) for c in containers]
+        self._field_getters[table_name] = tuple(
+            _fields_getter(fields) for fields in container_fields
+        )
+
+        # list of (transform or None, index of container, index of field)
+        # for each column, in the order of the fields of the table's dtype,
+        # so that _append_row() can pack a whole row at once without looking
+        # anything up. If several containers have the same field, the last
+        # one is written, as when setting the columns one by one.
+        colnames = set(table.colnames)
+        transforms = self._transforms[table_name]
+        sources = {}
+        for ci, fields in enumerate(container_fields):
+            for fi, colname in enumerate(fields):
+                if colname in colnames:
+                    sources[colname] = (transforms.get(colname), ci, fi)
+
+        # times are collected as they are and converted all at once when
+        # the buffer is flushed, since Time.mjd is slow for single values.
+        # The times of a row are only kept once the row has been buffered,
+        # see _buffer_row().
+        buffer_rows = min(self.flush_every,
+                          max(1, self.max_buffer_bytes // table.rowsize))
+        buffer = self._buffers[table_name] = _TableBuffer(table, buffer_rows)
+        for colname, (tr, ci, fi) in sources.items():
+            if tr is tr_time_to_float:
+                buffer.deferred_times[colname] = []
+                sources[colname] = (
+                    partial(_defer_time, pending=buffer.pending_times,
+                            colname=colname),
+                    ci, fi
+                )
+
+        self._plan[table_name] = [
+            sources[colname] for colname in table.dtype.names
+        ]
+
     def _append_row(self, table_name, containers):
         """
         append a row to an already initialized table. This is called
-        automatically by `write()`
+        automatically by `write_many()`
         """
-        table = self._tables[table_name]
-        row = table.row
+        fields = [
+            getter(container) for getter, container
+            in zip(self._field_getters[table_name], containers)
+        ]
+
+        values = []
+        append = values.append
+        for tr, ci, fi in self._plan[table_name]:
+            value = fields[ci][fi]
+            if tr is not None:
+                value = tr(value)
+            append(value)
+
+        self._buffer_row(table_name, tuple(values))
+
+    def _append_row_single(self, table_name, container):
+        """
+        append a row filled from a single container to an already
+        initialized table. This is called automatically by `write_one()`
+        """
+        fields = self._field_getters[table_name][0](container)
 
-        for container in containers:
-            for colname in filter(lambda c: c in table.colnames, container.keys()):
-                value = self._apply_col_transform(
-                    table_name, colname, container[colname]
+        values = []
+        append = values.append
+        for tr, _, fi in self._plan[table_name]:
+            value = fields[fi]
+            if tr is not None:
+                value = tr(value)
+            append(value)
+
+        self._buffer_row(table_name, tuple(values))
+
+    def _buffer_row(self, table_name, values):
+        """
+        store the tuple of column values in the buffer of the table, and
+        write the buffer to the table once it is full.
+        """
+        buffer = self._buffers[table_name]
+        n_rows = buffer.n_rows
+
+        # numpy packs the whole row into the structured buffer in one call
+        buffer.rows[n_rows] = values
+
+        # each row sets all of the pending times, so values left by a row
+        # that failed are always overwritten before getting here
+        pending = buffer.pending_times
+        if pending:
+            deferred = buffer.deferred_times
+            for colname, thetime in pending.items():
+                deferred[colname].append(thetime)
+
+        buffer.n_rows = n_rows + 1
+        if n_rows + 1 >= len(buffer.rows):
+            buffer.flush()
+
+    def _check_n_containers(self, table_name, n_containers):
+        """ the rows of a table must be written from the same containers
+        as the ones it was created from """
+        n_expected = len(self._field_getters[table_name])
+        if n_containers != n_expected:
+            raise ValueError(
+                "Table '{}' was created from {} container(s), but {} were "
+                "given: write the same containers to it".format(
+                    table_name, n_expected, n_containers
                 )
+            )
+
+    def write_one(self, table_name, container, expectedrows=None):
+        """
+        Write the contents of a single container to a table, see `write()`.
+
+        Parameters
+        ----------
+        table_name: str
+            name of table to write to
+        container: `ctapipe.core.Container`
+            container to write
+        expectedrows: int or None
+            estimated number of rows of the table, only used when the table
+            is created. If None, the value given to the constructor is used.
+        """
+        self._check_open()
+        if table_name not in self._schemas:
+            self._setup_new_table(table_name, (container, ), expectedrows)
+        else:
+            self._check_n_containers(table_name, 1)
+
+        self._append_row_single(table_name, container)
 
-                row[colname] = value
+    def write_many(self, table_name, containers, expectedrows=None):
+        """
+        Write the contents of several containers to a single row of a
+        table, see `write()`. The same types of containers must be passed,
+        in the same order, on each call.
+
+        Parameters
+        ----------
+        table_name: str
+            name of table to write to
+        containers: `Sequence[ctapipe.core.Container]`
+            containers to write
+        expectedrows: int or None
+            estimated number of rows of the table, only used when the table
+            is created. If None, the value given to the constructor is used.
+        """
+        self._check_open()
+        if table_name not in self._schemas:
+            self._setup_new_table(table_name, containers, expectedrows)
+        else:
+            self._check_n_containers(table_name, len(containers))
 
-        row.append()
+        self._append_row(table_name, containers)
 
-    def write(self, table_name, containers):
+    def write(self, table_name, containers, expectedrows=None):
         """
         Write the contents of the given container or containers to a table.
         The first call to write  will create a schema and initialize the table
@@ -231,14 +471,58 @@ class HDF5TableWriter(TableWriter):
             name of table to write to
         containers: `ctapipe.core.Container` or `Iterable[ctapipe.core.Container]`
             container to write
+        expectedrows: int or None
+            estimated number of rows of the table, only used when the table
+            is created. If None, the value given to the constructor is used.
         """
         if isinstance(containers, Container):
-            containers = (containers, )
+            self.write_one(table_name, containers, expectedrows)
+        else:
+            self.write_many(table_name, containers, expectedrows)
 
-        if table_name not in self._schemas:
-            self._setup_new_table(table_name, containers)
 
-        self._append_row(table_name, containers)
+class _TableBuffer:
+    """
+    Rows of an output table kept in memory by `HDF5TableWriter`, until they
+    are written to the table in a single `tables.Table.append()` call
+    """
+
+    def __init__(self, table, max_rows):
+        self.table = table
+        self.rows = np.empty(max_rows, dtype=table.dtype)
+        self.n_rows = 0
+        # raw times of the buffered rows of each Time column, and the times
+        # of the row being written, see `_defer_time()`
+        self.deferred_times = {}
+        self.pending_times = {}
+
+    def flush(self):
+        """ write the buffered rows to the table """
+        if self.n_rows > 0:
+            for colname, times in self.deferred_times.items():
+                self.rows[colname][:self.n_rows] = _times_to_mjd(times)
+                del times[:]
+
+            self.table.append(self.rows[:self.n_rows])
+            self.n_rows = 0
+
+
+def _flush_buffers(h5file, buffers):
+    """ write the rows of all `_TableBuffer`s, if the file is still open.
+    If a buffer cannot be written, the others are still written and the
+    first error is raised afterwards."""
+    if not h5file.isopen:
+        return
+
+    errors = []
+    for buffer in buffers.values():
+        try:
+            buffer.flush()
+        except Exception as err:
+            errors.append(err)
+
+    if errors:
+        raise errors[0]
 
 
 class HDF5TableReader(TableReader):
@@ -283,6 +567,7 @@ class HDF5TableReader(TableReader):
 
         super().__init__()
         self._tables = {}
+        self._read_plan = {}
         kwargs.update(mode='r')
 
         self.open(filename, **kwargs)
@@ -300,6 +585,14 @@ class HDF5TableReader(TableReader):
         self._tables[table_name] = tab
         self._map_table_to_container(table_name, container)
         self._map_transforms_from_table_header(table_name)
+
+        # (column name, transform or None) for each column to read, so that
+        # read() does not have to look up the transforms on each row
+        transforms = self._transforms[table_name]
+        self._read_plan[table_name] = [
+            (colname, transforms.get(colname))
+            for colname in self._cols_to_read[table_name]
+        ]
         return tab
 
     def _map_transforms_from_table_header(self, table_name):
@@ -310,7 +603,8 @@ class HDF5TableReader(TableReader):
         for attr in tab.attrs._f_list():
             if attr.endswith("_UNIT"):
                 colname = attr[:-5]
-                tr = partial(tr_add_unit, unitname=tab.attrs[attr])
+                tr = partial(tr_attach_unit,
+                             unit=_unit_from_string(tab.attrs[attr]))
                 self.add_column_transform(table_name, colname, tr)
 
     def _map_table_to_container(self, table_name, container):
@@ -348,38 +642,129 @@ class HDF5TableReader(TableReader):
         else:
             tab = self._tables[table_name]
 
-        row_count = 0
-
-        while 1:
-
-            try:
-                row = tab[row_count]
-            except IndexError:
-                return  # stop generator when done
-
-            for colname in self._cols_to_read[table_name]:
-                container[colname] = self._apply_col_transform(table_name,
-                                                               colname,
-                                                               row[colname])
-
-            yield container
-            row_count += 1
+        plan = self._read_plan[table_name]
+        set_field = partial(setattr, container)
+
+        # read the table in chunks of the size of the pytables I/O buffer
+        # rather than seeking to each row separately. Unlike Table.iterrows(),
+        # indexing the columns of a chunk gives numpy scalars, as reading
+        # single rows does.
+        chunk_size = tab.nrowsinbuf
+        start = 0
+        while start < tab.nrows:
+            chunk = tab.read(start, start + chunk_size)
+            start += len(chunk)
+
+            columns = [(colname, tr, chunk[colname]) for colname, tr in plan]
+            for i in range(len(chunk)):
+                for colname, tr, column in columns:
+                    value = column[i]
+                    if tr is not None:
+                        value = tr(value)
+                    set_field(colname, value)
+
+                yield container
+
+
+def _defer_time(thetime, pending, colname):
+    """ store the time of the row being written, to be converted by
+    `_times_to_mjd` later, returning a placeholder value for the column.
+    Anything but a scalar `Time` is converted right away, so that invalid
+    values raise when they are written, not when the buffer is flushed."""
+    if isinstance(thetime, Time) and thetime.isscalar:
+        pending[colname] = thetime
+        return np.nan
+
+    mjd = float(tr_time_to_float(thetime))
+    pending[colname] = mjd
+    return mjd
+
+
+def _times_to_mjd(times):
+    """ convert a list of scalar `Time` (or MJD already converted by
+    `_defer_time`) to MJD, in a single call if they are all `Time` with the
+    same time scale"""
+    scale = getattr(times[0], 'scale', None)
+    if all(isinstance(t, Time) and t.scale == scale for t in times):
+        # for scalar times, the public jd1/jd2 properties are as slow as
+        # Time.mjd itself, so use the internal representation directly.
+        # `Time._time` is private astropy API, present from astropy 1.0 up to
+        # at least 8.0: fall back to the public properties if it changes.
+        try:
+            jd1 = [t._time.jd1 for t in times]
+            jd2 = [t._time.jd2 for t in times]
+        except AttributeError:
+            jd1 = [t.jd1 for t in times]
+            jd2 = [t.jd2 for t in times]
+        return Time(np.array(jd1, dtype=np.float64),
+                    np.array(jd2, dtype=np.float64),
+                    format='jd', scale=scale).mjd
+    return [tr_time_to_float(t) if isinstance(t, Time) else t for t in times]
+
+
+def _fields_getter(names):
+    """ returns a function giving the tuple of values of the named fields
+    of a container"""
+    if not names:
+        return lambda container: ()
+    if len(names) == 1:
+        name = names[0]
+        return lambda container: (getattr(container, name), )
+    return attrgetter(*names)
 
 
 def tr_convert_and_strip_unit(quantity, unit):
     return quantity.to(unit).value
 
 
+def tr_scale_and_strip_unit(quantity, unit, from_unit, factor):
+    """ convert using a precomputed scale factor from `from_unit` to `unit`,
+    falling back to a full conversion if the quantity has another unit"""
+    if quantity.unit == from_unit:
+        if factor == 1:
+            return quantity.value
+        return quantity.value * factor
+    return tr_convert_and_strip_unit(quantity, unit)
+
+
 def tr_list_to_mask(thelist, length):
     """ transform list to a fixed-length mask"""
-    arr = np.zeros(shape=length, dtype=np.bool)
+    arr = np.zeros(shape=length, dtype=np.bool_)
     arr[thelist] = True
     return arr
 
 
+def make_list_to_mask(length):
+    """
+    Returns a transform that turns a list into a fixed-length mask, like
+    `tr_list_to_mask`, but fills the same preallocated array on each call
+    instead of allocating a new one. The returned mask is overwritten by
+    the next call, which is fine for `HDF5TableWriter` since it copies each
+    value into its row buffer immediately.
+    """
+    mask = np.zeros(shape=length, dtype=np.bool_)
+
+    def tr(thelist):
+        mask.fill(False)
+        mask[thelist] = True
+        return mask
+
+    return tr
+
+
 def tr_time_to_float(thetime):
     return thetime.mjd
 
 
 def tr_add_unit(value, unitname):
-    return Quantity(value, unitname)
+    return tr_attach_unit(value, _unit_from_string(unitname))
+
+
+def tr_attach_unit(value, unit):
+    """ attach an already parsed `astropy.units.Unit` to the value """
+    return Quantity(value, unit)
+
+
+@lru_cache()
+def _unit_from_string(unitname):
+    return Unit(unitname)
@@ -21,7 +21,10 @@ class TableWriter(Component, metaclass=ABCMeta):
     def __init__(self, parent=None, **kwargs):
         super().__init__(parent, **kwargs)
         self._transforms = defaultdict(dict)
-        self._exclusions = defaultdict(list)
+        self._exclusions = defaultdict(
+            lambda: {'patterns': [], 'combined': None}
+        )
+        self._excluded_cache = {}
 
     def __enter__(self):
 
@@ -42,13 +45,26 @@ class TableWriter(Component, metaclass=ABCMeta):
         pattern: str
             regular expression string to match column name
         """
-        self._exclusions[table_name].append(re.compile(pattern))
+        exclusions = self._exclusions[table_name]
+        exclusions['patterns'].append(re.compile(pattern))
+        exclusions['combined'] = None
+        self._excluded_cache = {
+            key: excluded for key, excluded in self._excluded_cache.items()
+            if key[0] != table_name
+        }
 
     def _is_column_excluded(self, table_name, col_name):
-        for pattern in self._exclusions[table_name]:
-            if pattern.match(col_name):
-                return True
-        return False
+        key = (table_name, col_name)
+        if key not in self._excluded_cache:
+            exclusions = self._exclusions[table_name]
+            if exclusions['combined'] is None:
+                exclusions['combined'] = _combine_patterns(
+                    exclusions['patterns']
+                )
+            self._excluded_cache[key] = any(
+                pattern.match(col_name) for pattern in exclusions['combined']
+            )
+        return self._excluded_cache[key]
 
     def add_column_transform(self, table_name, col_name, transform):
         """
@@ -116,6 +132,22 @@ class TableWriter(Component, metaclass=ABCMeta):
         return value
 
 
+def _combine_patterns(patterns):
+    """
+    Returns a list of compiled patterns equivalent to `patterns`: a single
+    alternation that matches all of them in one pass, if that does not
+    change their meaning, otherwise the patterns themselves. Patterns with
+    flags (passed to `re.compile` or inline) or with groups, which may be
+    referred to by number, are not combined.
+    """
+    default_flags = re.compile('').flags
+    if len(patterns) < 2 or any(p.flags != default_flags or p.groups
+                                for p in patterns):
+        return list(patterns)
+    return [re.compile("|".join("(?:{})".format(p.pattern)
+                                for p in patterns))]
+
+
 class TableReader(Component, metaclass=ABCMeta):
     """
     Base class for row-wise table readers. Generally methods that read a
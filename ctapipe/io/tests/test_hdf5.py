@@ -1,13 +1,19 @@
+import re
+import subprocess
+import sys
 import tempfile
 
 import numpy as np
 import pytest
 import tables
 from astropy import units as u
+from astropy.time import Time
 
 from ctapipe.core.container import Container, Field
 from ctapipe.io.containers import R0CameraContainer, MCEventContainer
-from ctapipe.io.hdf5tableio import HDF5TableWriter, HDF5TableReader
+from ctapipe.io.hdf5tableio import (
+    HDF5TableWriter, HDF5TableReader, make_list_to_mask
+)
 
 
 @pytest.fixture(scope='session')
@@ -71,6 +77,380 @@ def test_write_containers(temp_h5_file):
         writer.close()
 
 
+def test_write_compression():
+
+    class C1(Container):
+        a = Field(0, 'a')
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test') as writer:
+            writer.write("tel_001", C1())
+            filters = writer._tables["tel_001"].filters
+            assert filters.complib == 'blosc:lz4'
+            assert filters.complevel == 5
+
+        with HDF5TableWriter(f.name, 'test', complevel=0) as writer:
+            writer.write("tel_001", C1())
+            assert writer._tables["tel_001"].filters.complevel == 0
+
+
+def test_write_expectedrows():
+
+    class C1(Container):
+        a = Field(0.0, 'a')
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test', expectedrows=10) as writer:
+            writer.write("small", C1())
+            writer.write("large", C1(), expectedrows=10**7)
+
+            small = writer._tables["small"].chunkshape[0]
+            large = writer._tables["large"].chunkshape[0]
+            assert small < large
+
+
+def test_write_numpy_dtypes():
+
+    class C1(Container):
+        image = Field(None, 'image')
+        peak = Field(None, 'peak')
+        width = Field(None, 'width')
+
+    c1 = C1()
+    c1.image = np.arange(10, dtype=np.uint8)
+    c1.peak = np.int16(-3)
+    c1.width = np.float16(0.5)
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test') as writer:
+            writer.write("tel_001", c1)
+
+        with HDF5TableReader(f.name) as reader:
+            c = next(reader.read('/test/tel_001', C1()))
+            coldtypes = reader._tables['/test/tel_001'].coldtypes
+
+        assert coldtypes['image'] == np.dtype((np.uint8, (10,)))
+        assert coldtypes['peak'] == np.int16
+        assert coldtypes['width'] == np.float16
+        assert np.all(c.image == np.arange(10))
+        assert c.peak == -3
+        assert c.width == 0.5
+
+
+def test_read_numpy_types():
+
+    class C1(Container):
+        f32 = Field(np.float32(1.5), 'float32')
+        f64 = Field(np.float64(2.5), 'float64')
+        i32 = Field(np.int32(3), 'int32')
+        flag = Field(np.bool_(True), 'bool')
+        image = Field(np.arange(4, dtype=np.float32), 'image')
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test', flush_every=2) as writer:
+            for i in range(5):
+                writer.write("tel_001", C1())
+
+        with HDF5TableReader(f.name) as reader:
+            images = []
+            for c in reader.read('/test/tel_001', C1()):
+                assert type(c.f32) is np.float32 and c.f32 == 1.5
+                assert type(c.f64) is np.float64 and c.f64 == 2.5
+                assert type(c.i32) is np.int32 and c.i32 == 3
+                assert type(c.flag) is np.bool_ and c.flag
+                assert c.image.dtype == np.float32
+                images.append(c.image)
+
+        # values read earlier are not overwritten by later rows
+        assert len(images) == 5
+        assert all(np.all(image == np.arange(4)) for image in images)
+
+
+def test_add_column_transform_after_write():
+
+    class C1(Container):
+        a = Field(0, 'a')
+        t = Field(None, 'time')
+
+    c1 = C1(a=1, t=Time(58000.5, format='mjd'))
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test') as writer:
+            writer.write("tel_001", c1)
+            writer.add_column_transform("tel_001", "a", lambda x: x * 10)
+            writer.add_column_transform("tel_001", "t", lambda x: x.mjd + 1)
+            writer.write("tel_001", c1)
+
+        with HDF5TableReader(f.name) as reader:
+            written = [(c.a, c.t) for c in reader.read('/test/tel_001', C1())]
+
+        assert written == [(1, 58000.5), (10, 58001.5)]
+
+
+def test_write_exclusions():
+
+    class C1(Container):
+        a = Field(0, 'a')
+        b = Field(0, 'b')
+        c = Field(0, 'c')
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test') as writer:
+            writer.exclude("tel_001", "a")
+            writer.exclude("tel_001", "c")
+            writer.write("tel_001", C1())
+            writer.write("tel_002", C1())
+
+            assert writer._tables["tel_001"].colnames == ['b']
+            assert writer._tables["tel_002"].colnames == ['a', 'b', 'c']
+
+
+def test_write_exclusions_with_flags():
+
+    class C1(Container):
+        a = Field(0, 'a')
+        b = Field(0, 'b')
+        c = Field(0, 'c')
+        bb = Field(0, 'bb')
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test') as writer:
+            writer.exclude("tel_001", "(?i)A")
+            writer.exclude("tel_001", re.compile("C", re.IGNORECASE))
+            writer.exclude("tel_001", r"(b)\1")
+            writer.write("tel_001", C1())
+
+            assert writer._tables["tel_001"].colnames == ['b']
+
+
+def test_list_to_mask():
+
+    tr = make_list_to_mask(5)
+
+    assert np.all(tr([0, 2]) == [True, False, True, False, False])
+    assert np.all(tr([]) == np.zeros(5, dtype=bool))
+    assert np.all(tr([1, 4]) == [False, True, False, False, True])
+
+
+def test_write_buffered_rows():
+
+    class C1(Container):
+        a = Field(0, 'a')
+
+    c1 = C1()
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test', flush_every=7) as writer:
+            for i in range(20):
+                c1.a = i
+                writer.write("tel_001", c1)
+
+            # only complete buffers have been written so far
+            assert writer._tables["tel_001"].nrows == 14
+
+        with HDF5TableReader(f.name) as reader:
+            values = [c.a for c in reader.read('/test/tel_001', C1())]
+
+        assert values == list(range(20))
+
+
+def test_write_converts_units():
+
+    class C1(Container):
+        energy = Field(0 * u.TeV, 'energy', unit=u.GeV)
+
+    c1 = C1()
+    energies = [1 * u.TeV, 2 * u.TeV, 500 * u.MeV]
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test') as writer:
+            for energy in energies:
+                c1.energy = energy
+                writer.write("tel_001", c1)
+
+        with HDF5TableReader(f.name) as reader:
+            for c, energy in zip(reader.read('/test/tel_001', C1()),
+                                 energies):
+                assert c.energy.unit == u.GeV
+                assert np.isclose(c.energy.value, energy.to(u.GeV).value)
+
+
+def test_write_times():
+
+    class C1(Container):
+        time = Field(None, 'time')
+
+    c1 = C1()
+    times = [
+        Time(58000.5, format='mjd'),
+        Time('2018-01-01T00:00:00', scale='utc'),
+        Time(58000.5, format='mjd', scale='tai'),
+        Time(58001.25, format='mjd'),
+        Time(58002.0, format='mjd'),
+    ]
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test', flush_every=3) as writer:
+            for time in times:
+                c1.time = time
+                writer.write("tel_001", c1)
+
+        with HDF5TableReader(f.name) as reader:
+            for c, time in zip(reader.read('/test/tel_001', C1()), times):
+                assert c.time == time.mjd
+
+
+def test_write_times_after_failed_row():
+
+    class C1(Container):
+        t = Field(None, 'time')
+        u_e = Field(0 * u.TeV, 'energy', unit=u.GeV)
+
+    c1 = C1()
+    rows = [
+        (Time(58000.5, format='mjd'), 1 * u.TeV),
+        (Time(58001.5, format='mjd'), 1 * u.m),  # cannot be converted
+        (Time(58002.5, format='mjd'), 2 * u.TeV),
+    ]
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test') as writer:
+            for time, energy in rows:
+                c1.t, c1.u_e = time, energy
+                try:
+                    writer.write("tel_001", c1)
+                except u.UnitConversionError:
+                    pass
+
+        with HDF5TableReader(f.name) as reader:
+            written = [(c.t, c.u_e.value)
+                       for c in reader.read('/test/tel_001', C1())]
+
+        assert written == [(58000.5, 1000.0), (58002.5, 2000.0)]
+
+
+def test_write_invalid_time():
+
+    class C1(Container):
+        t = Field(None, 'time')
+
+    c1 = C1()
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test') as writer:
+            for i in range(5):
+                c1.t = Time(58000.0 + i, format='mjd')
+                writer.write("times", c1)
+                writer.write("other", c1)
+
+            c1.t = 58000.0
+            with pytest.raises(AttributeError):
+                writer.write("times", c1)
+
+        with HDF5TableReader(f.name) as reader:
+            for table_name in ('/test/times', '/test/other'):
+                values = [c.t for c in reader.read(table_name, C1())]
+                assert values == [58000.0 + i for i in range(5)]
+
+
+def test_write_one_and_many():
+
+    class C1(Container):
+        a = Field(0, 'a')
+
+    class C2(Container):
+        b = Field(0, 'b')
+
+    c1, c2 = C1(), C2()
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test') as writer:
+            for i in range(3):
+                c1.a, c2.b = i, 2 * i
+                writer.write_one("one", c1)
+                writer.write_many("many", (c1, c2))
+
+        with HDF5TableReader(f.name) as reader:
+            values = [c.a for c in reader.read('/test/one', C1())]
+            assert values == [0, 1, 2]
+            values = [c.b for c in reader.read('/test/many', C2())]
+            assert values == [0, 2, 4]
+
+
+def test_write_wrong_number_of_containers():
+
+    class C1(Container):
+        x = Field(0, 'x')
+        y = Field(0.0, 'y')
+
+    class C2(Container):
+        z = Field(0, 'z')
+        w = Field(0, 'w')
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test') as writer:
+            writer.write("tel_001", [C1(), C2()])
+
+            with pytest.raises(ValueError):
+                writer.write("tel_001", C1(x=10, y=20.0))
+
+            with pytest.raises(ValueError):
+                writer.write("tel_001", [C1()])
+
+            with pytest.raises(ValueError):
+                writer.write("tel_001", [C1(), C2(), C2()])
+
+            writer.write("tel_002", C1())
+            with pytest.raises(ValueError):
+                writer.write("tel_002", [C1(), C2()])
+
+
+def test_write_buffered_rows_at_exit():
+
+    class C1(Container):
+        a = Field(0, 'a')
+
+    script = (
+        "import numpy as np\n"
+        "from ctapipe.core.container import Container, Field\n"
+        "from ctapipe.io.hdf5tableio import HDF5TableWriter\n"
+        "class C1(Container):\n"
+        "    a = Field(0, 'a')\n"
+        "writer = HDF5TableWriter({!r}, 'test')\n"
+        "for i in range(50):\n"
+        "    writer.write('tel_001', C1(a=i))\n"
+    )
+
+    with tempfile.NamedTemporaryFile() as f:
+        # the writer is neither closed nor flushed before the script exits
+        subprocess.check_call([sys.executable, '-c', script.format(f.name)])
+
+        with HDF5TableReader(f.name) as reader:
+            values = [c.a for c in reader.read('/test/tel_001', C1())]
+
+    assert values == list(range(50))
+
+
+def test_write_buffer_size_limit():
+
+    class C1(Container):
+        waveform = Field(None, 'waveform')
+
+    c1 = C1()
+    c1.waveform = np.zeros((2, 1855, 40), dtype=np.uint16)
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test') as writer:
+            writer.write("tel_001", c1)
+            assert writer._buffers["tel_001"].rows.nbytes <= 16 * 1024**2
+
+        with HDF5TableWriter(f.name, 'test', max_buffer_bytes=1) as writer:
+            for i in range(3):
+                writer.write("tel_001", c1)
+                # a single row is always buffered, and written right away
+                assert writer._tables["tel_001"].nrows == i + 1
+
+
 def test_read_container(temp_h5_file):
     r0tel1 = R0CameraContainer()
     r0tel2 = R0CameraContainer()
@@ -176,6 +556,71 @@ def test_closing_writer(temp_h5_file):
         h5_table.close()
 
 
+def test_closing_writer_twice():
+
+    class C1(Container):
+        a = Field(0, 'a')
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test') as h5_table:
+            h5_table.write("tel_001", C1())
+            h5_table.close()
+
+        assert h5_table._h5file.isopen == False
+
+
+def test_write_after_close():
+
+    class C1(Container):
+        a = Field(0, 'a')
+
+    with tempfile.NamedTemporaryFile() as f:
+        with HDF5TableWriter(f.name, 'test') as h5_table:
+            h5_table.write("tel_001", C1())
+
+        with pytest.raises(tables.ClosedFileError):
+            h5_table.write("tel_001", C1())
+
+        with pytest.raises(tables.ClosedFileError):
+            h5_table.write("tel_002", C1())
+
+
+def test_close_flushes_all_tables_on_error():
+
+    class C1(Container):
+        a = Field(0, 'a')
+
+    def fail():
+        raise RuntimeError()
+
+    with tempfile.NamedTemporaryFile() as f:
+        with pytest.raises(RuntimeError):
+            with HDF5TableWriter(f.name, 'test') as h5_table:
+                h5_table.write("tel_001", C1())
+                h5_table.write("tel_002", C1())
+                h5_table._buffers["tel_001"].flush = fail
+
+        assert h5_table._h5file.isopen == False
+
+        with HDF5TableReader(f.name) as reader:
+            assert len(list(reader.read('/test/tel_002', C1()))) == 1
+
+
+def test_writer_flushes_on_error():
+
+    class C1(Container):
+        a = Field(0, 'a')
+
+    with tempfile.NamedTemporaryFile() as f:
+        with pytest.raises(RuntimeError):
+            with HDF5TableWriter(f.name, 'test') as h5_table:
+                h5_table.write("tel_001", C1())
+                raise RuntimeError()
+
+        with HDF5TableReader(f.name) as reader:
+            assert len(list(reader.read('/test/tel_001', C1()))) == 1
+
+
 def test_cannot_read_with_writer(temp_h5_file):
 
     with pytest.raises(IOError):